@@ -6,23 +6,50 @@ as long as the vector db provider correctly implements the VectorDBProvider inte
 """
 
 import os
+import copy
 from enum import StrEnum, auto
+from functools import lru_cache
 import json
-from typing import Dict
-import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+import orjson
 from openai import OpenAI
 from dotenv import load_dotenv
 from src.rag.vector_db_providers import VectorDBProvider
+from src.utils.semantic_cache import SemanticResponseCache
+from src.utils.tokenizer import get_tokenizer
 
 # Load environment variables
 load_dotenv()
 
+# Stand-ins for the per-query manifest fields, which are sent in the user message instead
+# so that the system message stays byte-identical across queries and hits the prompt prefix cache
+INFORMATION_PLACEHOLDER = "(given under BACKGROUND INFORMATION in the user message)"
+QUERY_PLACEHOLDER = "(given under QUERY in the user message)"
+# Stand-in for the category template when querying across all categories, which have no common one
+NO_REFERENCE = "(no reference is available, answer in a clear and concise technical style)"
+
 class MessageType(StrEnum):
     """Types of messages received from the user"""
     QUERY = auto()
     FEEDBACK = auto()
     OTHER = auto()
 
+@lru_cache(maxsize=64)
+def _read_text(path: str, mtime_ns: int) -> str:
+    """Read a text file, caching its content for as long as its modification time is unchanged"""
+    with open(path, "r", encoding="utf-8") as text_file:
+        return text_file.read()
+
+def _load_text_cached(path: str) -> str:
+    """Read a text file, hitting the disk only when it changed since the last read"""
+    return _read_text(path, os.stat(path).st_mtime_ns)
+
+@lru_cache(maxsize=64)
+def _render_system_prompt(manifest: str, reference: str) -> str:
+    """Fill in the manifest fields that do not change between queries"""
+    return manifest.format(information=INFORMATION_PLACEHOLDER, query=QUERY_PLACEHOLDER, reference=reference)
+
 class QueryController:
     """Defines methods to process the user query using AI"""
     def __init__(self, vector_db_provider: VectorDBProvider):
@@ -30,7 +57,31 @@ class QueryController:
         self.openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.chat_model = "gpt-3.5-turbo"
         self.vector_db_provider = vector_db_provider
-        self.tokenizer = tiktoken.encoding_for_model(self.chat_model)
+        self.tokenizer = get_tokenizer(self.chat_model)
+        dirname = os.path.dirname(os.path.abspath(__file__))
+        self.manifest_path = os.path.normpath(os.path.join(dirname, "../../../manifest/manifest.txt"))
+        self.documents_path = os.path.normpath(os.path.join(dirname, "../../../documents"))
+        # One answer cache per category, along with the modification times of the prompt files
+        # its answers were generated with, since answers depend on those files too
+        self._answer_caches: Dict[Optional[str], Tuple[Tuple[int, Optional[int]], SemanticResponseCache]] = {}
+        # Reads files in the background while network calls are in flight
+        self._io_executor = ThreadPoolExecutor(max_workers=2)
+        # Category searched by query and stream_query, set with with_category
+        self.category: Optional[str] = None
+
+    def with_category(self, tag: Optional[str]) -> "QueryController":
+        """
+        Get a controller that answers queries from the given category, sharing this controller's clients and caches
+        A tag of None answers queries from all categories
+        """
+        controller = copy.copy(self)
+        controller.category = tag
+        return controller
+
+    def warmup(self):
+        """Open the connections used to answer queries, so that the first query does not pay for them"""
+        self.vector_db_provider.warmup()
+        self.openai_client.models.retrieve(self.chat_model)
 
     def feedback_or_query(self, message: str) -> Dict[str, str]:
         """Determine if a user message is a query or a feedback"""
@@ -88,7 +139,12 @@ If the message is neither a query nor a feedback, your response should follow th
             )
         
         try:
-            response_json = json.loads(response.choices[0].message.content)
+            content = response.choices[0].message.content
+            try:
+                response_json = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                # The standard library parser accepts some input orjson rejects, such as NaN
+                response_json = json.loads(content)
             return response_json
 
         except Exception as e:
@@ -98,10 +154,7 @@ If the message is neither a query nor a feedback, your response should follow th
     def generate_manifest_change(self, feedback: str) -> str:
         """Modify manifest"""
         try:
-            dirname = os.path.dirname(__file__)
-            manifest_path = os.path.join(dirname, "../../../manifest/manifest.txt")
-            with open(manifest_path, "r", encoding="utf-8") as manifest_file:
-                manifest = manifest_file.read()
+            manifest = _load_text_cached(self.manifest_path)
         except Exception as e:
             print(f"Failed to read manifest: {e}")
             raise e
@@ -144,13 +197,60 @@ Your response should be simply the modified document.
             return f"Error generating response: {e}"
 
     
-    def query_with_rag(self, tag: str, question: str, max_context_length: int = 3000) -> str:
+    def query(self, question: str, max_context_length: int = 3000) -> str:
+        """Query using RAG in the category the controller is bound to."""
+        return self.query_with_rag(self.category, question, max_context_length)
+
+    def stream_query(self, question: str, max_context_length: int = 3000) -> Iterator[str]:
+        """Stream the answer to a query in the category the controller is bound to."""
+        return self.stream_query_with_rag(self.category, question, max_context_length)
+
+    def query_with_rag(self, tag: Optional[str], question: str, max_context_length: int = 3000) -> str:
         """Query using RAG: retrieve relevant chunks and generate answer."""
+        return "".join(self.stream_query_with_rag(tag, question, max_context_length))
+
+    def stream_query_with_rag(self, tag: Optional[str], question: str, max_context_length: int = 3000) -> Iterator[str]:
+        """Query using RAG, yielding the answer piece by piece as it is generated."""
+        try:
+            manifest_mtime = os.stat(self.manifest_path).st_mtime_ns
+            if tag is None:
+                reference_path = reference_mtime = None
+            else:
+                reference_path = os.path.join(self.documents_path, tag, "template.md")
+                reference_mtime = os.stat(reference_path).st_mtime_ns
+        except Exception as e:
+            print(f"Failed to read manifest: {e}")
+            raise e
+        
+        # Read the prompt files while the question is looked up in the cache and searched for
+        manifest_future = self._io_executor.submit(_read_text, self.manifest_path, manifest_mtime)
+        if reference_path is not None:
+            reference_future = self._io_executor.submit(_read_text, reference_path, reference_mtime)
+        
+        # Answer from the cache if the same or a near-identical question was already answered,
+        # only embedding the question when it is not an exact repeat
+        prompt_mtimes = (manifest_mtime, reference_mtime)
+        cached_mtimes, answer_cache = self._answer_caches.get(tag, (None, None))
+        if cached_mtimes != prompt_mtimes:
+            # Answers generated with older prompt files are dropped
+            answer_cache = SemanticResponseCache()
+            self._answer_caches[tag] = (prompt_mtimes, answer_cache)
+        cached_answer = answer_cache.get_exact(question)
+        if cached_answer is None:
+            question_embedding = self.vector_db_provider.embed(question)
+            cached_answer = answer_cache.get_similar(question_embedding)
+        if cached_answer is not None:
+            yield cached_answer
+            return
+        
         # Search for relevant chunks
-        search_results = self.vector_db_provider.search_similar(tag, question, limit=10)
+        search_results = self.vector_db_provider.search_similar(
+            tag, question, limit=10, query_embedding=question_embedding
+        )
         
         if not search_results:
-            return "I couldn't find any relevant information to answer your question."
+            yield "I couldn't find any relevant information to answer your question."
+            return
         
         # Build context from search results
         context_pieces = []
@@ -158,7 +258,10 @@ Your response should be simply the modified document.
         
         for result in search_results:
             text = result["text"]
-            tokens = len(self.tokenizer.encode(text))
+            tokens = result.get("token_count")
+            # Chunks indexed before token counts were stored are tokenized here
+            if tokens is None:
+                tokens = len(self.tokenizer.encode(text))
             
             if total_tokens + tokens > max_context_length:
                 break
@@ -168,33 +271,39 @@ Your response should be simply the modified document.
         
         context = "\n\n".join(context_pieces)
         
-        # Generate answer using OpenAI
         try:
-            dirname = os.path.dirname(__file__)
-            manifest_path = os.path.join(dirname, "../../../manifest/manifest.txt")
-            with open(manifest_path, "r", encoding="utf-8") as manifest_file:
-                manifest = manifest_file.read()
-            
-            reference_path = os.path.join(dirname, "../../../documents",tag,"template.md")
-            with open(reference_path, "r", encoding="utf-8") as reference_file:
-                reference = reference_file.read()
+            manifest = manifest_future.result()
+            reference = NO_REFERENCE if reference_path is None else reference_future.result()
         except Exception as e:
             print(f"Failed to read manifest: {e}")
             raise e
         
-        prompt = manifest.format(information=context,query=question, reference=reference)
+        # Generate answer using OpenAI, with the stable part of the prompt first
+        system_prompt = _render_system_prompt(manifest, reference)
+        user_prompt = f"BACKGROUND INFORMATION:\n{context}\n\nQUERY:\n{question}"
         
         try:
             response = self.openai_client.chat.completions.create(
                 model=self.chat_model,
                 messages=[
-                    {"role": "user","content": prompt}
+                    {"role": "system","content": system_prompt},
+                    {"role": "user","content": user_prompt}
                 ],
                 max_tokens=500,
-                temperature=0.1
+                temperature=0.1,
+                stream=True
             )
             
-            return response.choices[0].message.content
+            answer_pieces = []
+            for event in response:
+                if not event.choices:
+                    continue
+                
+                piece = event.choices[0].delta.content or ""
+                answer_pieces.append(piece)
+                yield piece
+            
+            answer_cache.put(question, question_embedding, "".join(answer_pieces))
             
         except Exception as e:
-            return f"Error generating response: {e}"
\ No newline at end of file
+            yield f"Error generating response: {e}"
\ No newline at end of file
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 class VectorDBProvider(ABC):
     """Vector database interface"""
@@ -8,5 +8,18 @@ class VectorDBProvider(ABC):
         """Index files into vector database"""
 
     @abstractmethod
-    def search_similar(self, tag: str, query: str, limit: int = 5) -> List[Dict[str, Any]]:
-        """Search for nodes that are similar to the query within the vector database"""
\ No newline at end of file
+    def embed(self, text: str) -> List[float]:
+        """Get the embedding used to compare the text against the vector database"""
+
+    @abstractmethod
+    def warmup(self):
+        """Open the connections used by searches ahead of the first one"""
+
+    @abstractmethod
+    def search_similar(self, tag: Optional[str], query: str, limit: int = 5,
+                       query_embedding: Optional[List[float]] = None) -> List[Dict[str, Any]]:
+        """
+        Search for nodes that are similar to the query within the vector database
+        Only nodes indexed with the tag are searched, or every node if the tag is None
+        If the query embedding was already computed, it is used instead of embedding the query again
+        """
\ No newline at end of file
@@ -4,53 +4,168 @@ Defining Qdrant as a VectorDBProvider implementation
 
 import os
 import glob
+import asyncio
+import hashlib
 import uuid
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-import tiktoken
-from openai import OpenAI
-from qdrant_client import QdrantClient, models
+import httpx
+import numpy as np
+from openai import OpenAI, AsyncOpenAI
+from qdrant_client import QdrantClient, AsyncQdrantClient, models
 from qdrant_client.models import PointStruct
 from dotenv import load_dotenv
+from src.utils.tokenizer import get_tokenizer
 from . import VectorDBProvider
 
 
 # Load environment variables
 load_dotenv()
 
+# Maximum number of files read and chunked in parallel while indexing
+MAX_CHUNKING_WORKERS = 8
+# Maximum number of embedding requests in flight at once while indexing
+MAX_CONCURRENT_EMBEDDINGS = 32
+# Number of chunks sent in a single embedding request
+EMBEDDING_BATCH_SIZE = 128
+# Number of points sent to Qdrant in a single upsert
+UPSERT_BATCH_SIZE = 256
+# Maximum number of connections kept open to Qdrant while indexing
+QDRANT_POOL_SIZE = 100
+# Size of the vectors produced by the embedding model
+EMBEDDING_DIMENSIONS = 1536
+# Maximum number of chunk embeddings kept to skip re-embedding unchanged chunks (about 6 KB each)
+EMBEDDING_CACHE_SIZE = 10_000
+# How many more candidates than requested are scored with the quantized vectors before rescoring
+QUANTIZATION_OVERSAMPLING = 2.0
+
+def _content_key(text: str) -> bytes:
+    """Hash identifying a chunk by its content"""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def _point_id(payload: Dict[str, Any]) -> str:
+    """Deterministic id of a chunk's point, so that reindexing a chunk overwrites its previous point"""
+    key = f'{payload["tag"]}|{payload["file_path"]}|{payload["chunk_index"]}|{payload["text"]}'
+    return str(uuid.UUID(bytes=_content_key(key)))
+
+@lru_cache(maxsize=64)
+def _tag_filter(tag: str) -> models.Filter:
+    """Filter restricting a search to the chunks of a tag, built once per tag"""
+    return models.Filter(
+        must=[
+            models.FieldCondition(
+                key="tag",
+                match=models.MatchValue(value=tag)
+            )
+        ]
+    )
+
 class Qdrant(VectorDBProvider):
     """Defines Qdrant as a Vector DB provider"""
     def __init__(self, collection_name: str, qdrant_host: str = "localhost", qdrant_port: int = 6333):
         """Initialize the RAG system with Qdrant and OpenAI clients."""
         self.openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         self.qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port)
+        self.qdrant_host = qdrant_host
+        self.qdrant_port = qdrant_port
         self.collection_name = collection_name
         self.embedding_model = "text-embedding-3-small"
         self.chat_model = "gpt-3.5-turbo"
-        self.tokenizer = tiktoken.encoding_for_model(self.chat_model)
+        self.tokenizer = get_tokenizer(self.chat_model)
+        # Embeddings of the chunks indexed so far as float32 arrays, keyed by a hash of their content,
+        # keeping only the EMBEDDING_CACHE_SIZE most recently used ones
+        self._emb_cache: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        # The collection is only checked when indexing, so that starting up for queries costs no round-trip
+        self._collection_ready = False
 
-    def _chunk_text(self, text: str, max_tokens: int = 500, overlap: int = 50) -> List[str]:
-        """Split text into chunks with overlap."""
-        tokens = self.tokenizer.encode(text)
-        chunks = []
-       
-        for i in range(0, len(tokens), max_tokens - overlap):
-            chunk_tokens = tokens[i:i + max_tokens]
-            chunk_text = self.tokenizer.decode(chunk_tokens)
-            chunks.append(chunk_text)
+    def _create_collection(self):
+        """
+        Create the collection if it does not exist and make sure its tag field is indexed
+        Original vectors and the HNSW graph are memory-mapped from disk, while int8-quantized
+        copies of the vectors are kept in RAM, so only the pages touched by rescoring are read
+        """
+        if self._collection_ready:
+            return
+        
+        quantization_config = models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                always_ram=True
+            )
+        )
+        
+        if not self.qdrant_client.collection_exists(self.collection_name):
+            self.qdrant_client.create_collection(
+                collection_name=self.collection_name,
+                vectors_config=models.VectorParams(size=EMBEDDING_DIMENSIONS, distance=models.Distance.COSINE, on_disk=True),
+                hnsw_config=models.HnswConfigDiff(on_disk=True),
+                quantization_config=quantization_config
+            )
+        else:
+            # Collections created before these settings were introduced are moved to them,
+            # updating to the settings a collection already has is a no-op
+            self.qdrant_client.update_collection(
+                collection_name=self.collection_name,
+                vectors_config={"": models.VectorParamsDiff(on_disk=True)},
+                hnsw_config=models.HnswConfigDiff(on_disk=True),
+                quantization_config=quantization_config
+            )
         
-        return chunks
+        # Searches are always filtered by tag, so tag values get their own index and storage layout
+        self.qdrant_client.create_payload_index(
+            collection_name=self.collection_name,
+            field_name="tag",
+            field_schema=models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True)
+        )
+        self._collection_ready = True
+
+    def _chunk_text(self, text: str, max_tokens: int = 500, overlap: int = 50) -> Tuple[List[str], List[int]]:
+        """Split text into chunks with overlap, returning the chunks and their token counts."""
+        tokens = self.tokenizer.encode(text)
+        starts = np.arange(0, len(tokens), max_tokens - overlap, dtype=np.int64)
+        ends = np.minimum(starts + max_tokens, len(tokens))
+        # decode_batch only maps decode over a thread pool of its own, which is slower for windows this size
+        chunks = [self.tokenizer.decode(tokens[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
+        return chunks, (ends - starts).tolist()
     
-    def _get_embedding(self, text: str) -> List[float]:
+    def embed(self, text: str) -> List[float]:
         """Get embedding for text using OpenAI API."""
         response = self.openai_client.embeddings.create(
             model=self.embedding_model,
             input=text
         )
         return response.data[0].embedding
+
+    def warmup(self):
+        """Open the connections to OpenAI and Qdrant ahead of the first search."""
+        self.embed("warmup")
+        self.qdrant_client.collection_exists(self.collection_name)
+
+    async def _aget_embeddings_batch(self, openai_client: AsyncOpenAI, texts: List[str]) -> List[List[float]]:
+        """Get embeddings for a batch of texts with a single async OpenAI API request."""
+        response = await openai_client.embeddings.create(
+            model=self.embedding_model,
+            input=texts
+        )
+        return [r.embedding for r in response.data]
+    
+    def _read_and_chunk(self, file_path: str) -> Tuple[List[str], List[int]]:
+        """Read a file and split it into chunks, returning the chunks and their token counts."""
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        
+        return self._chunk_text(content)
     
     def index_files(self, tag: str, file_pattern: str):
         """Index all text files matching the pattern."""
+        self._create_collection()
+        asyncio.run(self._aindex_files(tag, file_pattern))
+
+    async def _aindex_files(self, tag: str, file_pattern: str):
+        """Index all text files matching the pattern, overlapping embedding requests with Qdrant upserts."""
         files = glob.glob(file_pattern)
         
         if not files:
@@ -59,69 +174,155 @@ class Qdrant(VectorDBProvider):
         
         print(f"Found {len(files)} files to index")
         
-        points = []
-        for file_path in files:
-            print(f"Processing: {file_path}")
+        # Collect every non-empty chunk with its payload before embedding,
+        # reading and chunking the files in parallel
+        entries = []
+        with ThreadPoolExecutor(max_workers=MAX_CHUNKING_WORKERS) as executor:
+            futures = [executor.submit(self._read_and_chunk, file_path) for file_path in files]
             
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
+            for file_path, future in zip(files, futures):
+                print(f"Processing: {file_path}")
                 
-                # Split into chunks
-                chunks = self._chunk_text(content)
-                
-                for i, chunk in enumerate(chunks):
-                    if not chunk.strip():
-                        continue
+                try:
+                    chunks, token_counts = future.result()
                     
-                    # Get embedding
-                    embedding = self._get_embedding(chunk)
-                    
-                    # Create point
-                    point = PointStruct(
-                        id=str(uuid.uuid4()),
-                        vector=embedding,
-                        payload={
+                    for i, (chunk, token_count) in enumerate(zip(chunks, token_counts)):
+                        if not chunk.strip():
+                            continue
+                        
+                        entries.append((chunk, {
                             "text": chunk,
                             "tag": tag,
                             "file_path": file_path,
                             "file_name": Path(file_path).name,
                             "chunk_index": i,
-                            "total_chunks": len(chunks)
-                        }
-                    )
-                    points.append(point)
+                            "total_chunks": len(chunks),
+                            "token_count": token_count
+                        }))
+                    
+                    print(f"  Created {len(chunks)} chunks")
+                    
+                except Exception as e:
+                    print(f"Error processing {file_path}: {e}")
+        
+        if not entries:
+            return
+
+        # Identical chunks are embedded once, and chunks embedded by earlier runs are not embedded again
+        embedded = []
+        unseen: Dict[bytes, Tuple[str, List[Dict[str, Any]]]] = {}
+        for chunk, payload in entries:
+            key = _content_key(chunk)
+            if key in self._emb_cache:
+                self._emb_cache.move_to_end(key)
+                embedded.append((payload, self._emb_cache[key].tolist()))
+            else:
+                unseen.setdefault(key, (chunk, []))[1].append(payload)
+        
+        print(f"  Embedding {len(unseen)} unique new chunks")
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_EMBEDDINGS)
+        qdrant_client = AsyncQdrantClient(
+            host=self.qdrant_host,
+            port=self.qdrant_port,
+            limits=httpx.Limits(max_connections=QDRANT_POOL_SIZE, max_keepalive_connections=QDRANT_POOL_SIZE)
+        )
+        upserts = []
+        points = []
+
+        def flush_points():
+            nonlocal points
+            upserts.append((asyncio.create_task(self._aupsert(qdrant_client, points)), len(points)))
+            points = []
+
+        def add_points(payloads_with_embeddings):
+            for payload, embedding in payloads_with_embeddings:
+                points.append(PointStruct(
+                    id=_point_id(payload),
+                    vector=embedding,
+                    payload=payload
+                ))
                 
-                print(f"  Created {len(chunks)} chunks")
+                # Flush in the background while the remaining embedding requests are in flight
+                if len(points) >= UPSERT_BATCH_SIZE:
+                    flush_points()
+
+        failed = 0
+        # One client per run shares a single HTTP connection pool across all embedding requests
+        async with AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY")) as openai_client:
+            async def embed_window(window):
+                # A failed request only skips the chunks in its window, like a file that cannot be read
+                try:
+                    async with semaphore:
+                        embeddings = await self._aget_embeddings_batch(openai_client, [chunk for _, (chunk, _) in window])
+                except Exception as e:
+                    file_paths = sorted({payload["file_path"] for _, (_, payloads) in window for payload in payloads})
+                    print(f"Error embedding chunks of {', '.join(file_paths)}: {e}")
+                    return window, None
+                return window, embeddings
+
+            unseen_items = list(unseen.items())
+            windows = [unseen_items[i:i + EMBEDDING_BATCH_SIZE] for i in range(0, len(unseen_items), EMBEDDING_BATCH_SIZE)]
+            try:
+                add_points(embedded)
                 
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
-        
-        # Upload to Qdrant
-        if points:
-            self.qdrant_client.upsert(
-                collection_name=self.collection_name,
-                points=points
-            )
-            print(f"Successfully indexed {len(points)} chunks")
+                for next_window in asyncio.as_completed([embed_window(window) for window in windows]):
+                    window, embeddings = await next_window
+                    if embeddings is None:
+                        failed += sum(len(payloads) for _, (_, payloads) in window)
+                        continue
+                    
+                    for (key, (_, payloads)), embedding in zip(window, embeddings):
+                        self._cache_embedding(key, embedding)
+                        add_points((payload, embedding) for payload in payloads)
+            finally:
+                # Whatever was embedded is still sent, and the client is only closed once every upsert is done
+                if points:
+                    flush_points()
+                results = await asyncio.gather(*(task for task, _ in upserts), return_exceptions=True)
+                for result, (_, size) in zip(results, upserts):
+                    if isinstance(result, Exception):
+                        print(f"Error upserting {size} chunks: {result}")
+                        failed += size
+                await qdrant_client.close()
+
+        if failed:
+            print(f"Indexed {len(entries) - failed} chunks, {failed} chunks failed")
+        else:
+            print(f"Successfully indexed {len(entries)} chunks")
+
+    def _cache_embedding(self, key: bytes, embedding: List[float]):
+        """Keep the embedding of a chunk for later runs, evicting the least recently used one when full."""
+        self._emb_cache[key] = np.asarray(embedding, dtype=np.float32)
+        if len(self._emb_cache) > EMBEDDING_CACHE_SIZE:
+            self._emb_cache.popitem(last=False)
+
+    async def _aupsert(self, qdrant_client: AsyncQdrantClient, points: List[PointStruct]):
+        """Send a batch of points to Qdrant without waiting for it to be indexed."""
+        await qdrant_client.upsert(
+            collection_name=self.collection_name,
+            points=points,
+            wait=False
+        )
     
-    def search_similar(self, tag: str, query: str, limit: int = 5) -> List[Dict[str, Any]]:
+    def search_similar(self, tag: Optional[str], query: str, limit: int = 5,
+                       query_embedding: Optional[List[float]] = None) -> List[Dict[str, Any]]:
         """Search for similar text chunks."""
-        query_embedding = self._get_embedding(query)
+        if query_embedding is None:
+            query_embedding = self.embed(query)
         
         search_results = self.qdrant_client.search(
             collection_name=self.collection_name,
             query_vector=query_embedding,
             limit=limit,
             with_payload=True,
-            query_filter=models.Filter(
-            must=[
-                models.FieldCondition(
-                    key="tag",
-                    match=models.MatchValue(value=tag)
+            search_params=models.SearchParams(
+                quantization=models.QuantizationSearchParams(
+                    rescore=True,
+                    oversampling=QUANTIZATION_OVERSAMPLING
                 )
-            ]
-        )
+            ),
+            query_filter=_tag_filter(tag) if tag is not None else None
         )
         
         results = []
@@ -131,6 +332,7 @@ class Qdrant(VectorDBProvider):
                 "file_name": result.payload["file_name"],
                 "file_path": result.payload["file_path"],
                 "chunk_index": result.payload["chunk_index"],
+                "token_count": result.payload.get("token_count"),
                 "score": result.score
             })
         
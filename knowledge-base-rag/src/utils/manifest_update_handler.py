@@ -1,4 +1,9 @@
+from typing import List
 from src.rag.rag import QueryController
 
 def update_manifest(rag: QueryController, feedback: str):
-    print(rag.generate_manifest_change(feedback))
\ No newline at end of file
+    print(rag.generate_manifest_change(feedback))
+
+def update_manifest_many(rag: QueryController, feedbacks: List[str]) -> str:
+    """Get a single manifest change applying several feedback messages"""
+    return rag.generate_manifest_change("\n".join(feedbacks))
@@ -0,0 +1,67 @@
+"""
+Semantic response cache
+Answers are looked up by the cosine similarity of the embeddings of the questions that produced them,
+with an exact-match layer in front so that repeated questions do not even need to be embedded
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+import numpy as np
+
+# Minimum cosine similarity for a past question to be considered the same as a new one
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    """Scale an embedding to unit length, so that a dot product gives the cosine similarity"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _question_key(question: str) -> bytes:
+    """Hash identifying a question regardless of case and surrounding whitespace"""
+    return hashlib.blake2b(question.strip().casefold().encode("utf-8"), digest_size=16).digest()
+
+class SemanticResponseCache:
+    """LRU cache of answers, looked up either by question text or by question embedding"""
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_size: int = 512):
+        self.threshold = threshold
+        self.max_size = max_size
+        self._entries: OrderedDict[bytes, Tuple[np.ndarray, str]] = OrderedDict()
+        # Embeddings of all entries stacked into one matrix, rebuilt only after the entries change
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[bytes] = []
+
+    def _hit(self, key: bytes) -> str:
+        self._entries.move_to_end(key)
+        return self._entries[key][1]
+
+    def get_exact(self, question: str) -> Optional[str]:
+        """Get the answer to the same question, if it was already answered"""
+        key = _question_key(question)
+        if key not in self._entries:
+            return None
+        return self._hit(key)
+
+    def get_similar(self, embedding: List[float]) -> Optional[str]:
+        """Get the answer to the most similar past question, if it is similar enough"""
+        if not self._entries:
+            return None
+        
+        if self._matrix is None:
+            self._matrix_keys = list(self._entries)
+            self._matrix = np.stack([self._entries[key][0] for key in self._matrix_keys])
+        
+        similarities = self._matrix @ _normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self._hit(self._matrix_keys[best])
+
+    def put(self, question: str, embedding: List[float], answer: str):
+        """Store an answer, evicting the least recently used one when the cache is full"""
+        key = _question_key(question)
+        self._entries[key] = (_normalize(embedding), answer)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        self._matrix = None
@@ -0,0 +1,12 @@
+"""
+Shared tokenizer factory
+Building a tiktoken encoder is expensive, so each model's encoder is built once per process
+"""
+
+from functools import lru_cache
+import tiktoken
+
+@lru_cache(maxsize=8)
+def get_tokenizer(model: str) -> tiktoken.Encoding:
+    """Get the tokenizer used by the given model"""
+    return tiktoken.encoding_for_model(model)
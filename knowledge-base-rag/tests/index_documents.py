@@ -32,9 +32,10 @@ def main():
     # Index files from a specific directory
     print("Indexing documents...")
     try:
-        for dirpath, dirnames, _ in os.walk("/Users/rodrigocampos/knowledge-base-test/documents/"):
-            for dirname in dirnames:
-                vector_db_provider.index_files(dirname,os.path.join(dirpath, dirname,"*.txt"))  # Adjust path as needed
+        with os.scandir("/Users/rodrigocampos/knowledge-base-test/documents/") as entries:  # Adjust path as needed
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    vector_db_provider.index_files(entry.name, os.path.join(entry.path, "*.txt"))
     except Exception as e:
         print(f"Failed to index documents: {e}")
         raise e
@@ -4,40 +4,68 @@ Example usage of the RAG system with document category selection
 """
 
 import os
-from pathlib import Path
+import queue
+import sys
+import threading
+from functools import lru_cache
 from src.rag.rag import QueryController, MessageType
 from src.rag.vector_db_providers.init_vector_db import init_vector_db
-from src.utils.manifest_update_handler import update_manifest
+from src.utils.manifest_update_handler import update_manifest_many
+
+# Messages that end the session
+EXIT_COMMANDS = frozenset(('quit', 'exit', 'q'))
+# Feedback sent within this many seconds of the previous one is applied along with it
+FEEDBACK_DEBOUNCE_SECONDS = 0.075
+# Maximum number of feedback messages applied in a single manifest change
+FEEDBACK_BATCH_SIZE = 32
+# Prompt asking the user for the next message
+QUESTION_PROMPT = "\nYour question (or 'quit' to exit): "
+
+# Feedback waiting to be applied to the manifest, created along with its worker on the first feedback
+feedback_queue = None
+# Held while writing to stdout, so that the feedback worker does not write in the middle of an answer
+output_lock = threading.Lock()
+# Set while the user is being asked for questions, so that the feedback worker knows to repeat the prompt
+session_running = threading.Event()
+
+@lru_cache(maxsize=4)
+def scan_document_categories(docs_path, mtime_ns):
+    """List the category directories, cached until the documents directory is modified"""
+    # Get only directories (not files) from the documents path
+    with os.scandir(docs_path) as entries:
+        return tuple(sorted(entry.name for entry in entries if entry.is_dir(follow_symlinks=False)))
 
 def get_document_categories(docs_path):
     """Get available document categories from the documents directory"""
     try:
-        docs_dir = Path(docs_path)
-        if not docs_dir.exists():
+        try:
+            mtime_ns = os.stat(docs_path).st_mtime_ns
+        except FileNotFoundError:
             print(f"Warning: Documents path '{docs_path}' does not exist.")
             return []
         
-        # Get only directories (not files) from the documents path
-        categories = [d.name for d in docs_dir.iterdir() if d.is_dir()]
-        return sorted(categories)
+        return scan_document_categories(docs_path, mtime_ns)
     except Exception as e:
         print(f"Error reading document categories: {e}")
         return []
 
+@lru_cache(maxsize=4)
+def render_category_menu(categories):
+    """Render the category selection menu as a single string"""
+    menu = "\n".join(f"{i}. {category}" for i, category in enumerate(categories, 1))
+    separator = "-" * 40
+    return (
+        f"\nAvailable document categories:\n{separator}\n"
+        f"{menu}\n{len(categories) + 1}. All categories\n{separator}\n"
+    )
+
 def select_category(categories):
     """Present categories to user and get selection"""
     if not categories:
         print("No document categories found.")
         return None
     
-    print("\nAvailable document categories:")
-    print("-" * 40)
-    
-    for i, category in enumerate(categories, 1):
-        print(f"{i}. {category}")
-    
-    print(f"{len(categories) + 1}. All categories")
-    print("-" * 40)
+    sys.stdout.write(render_category_menu(tuple(categories)))
     
     while True:
         try:
@@ -63,6 +91,77 @@ def select_category(categories):
         except Exception as e:
             print(f"Invalid input: {e}")
 
+def print_answer(rag, message):
+    """Print the answer to a query as it is generated"""
+    # The prefix goes out with the first piece of the answer, and empty pieces are not written
+    prefix = "Answer: "
+    with output_lock:
+        for token in rag.stream_query(message):
+            if token:
+                sys.stdout.write(prefix + token)
+                sys.stdout.flush()
+                prefix = ""
+        sys.stdout.write(prefix + "\n")
+        sys.stdout.flush()
+
+def apply_feedback(feedback_queue):
+    """Update the manifest with queued feedback, merging feedback sent in quick succession"""
+    while True:
+        batch = [feedback_queue.get()]
+        try:
+            while len(batch) < FEEDBACK_BATCH_SIZE:
+                batch.append(feedback_queue.get(timeout=FEEDBACK_DEBOUNCE_SECONDS))
+        except queue.Empty:
+            pass
+        
+        # Every controller edits the same manifest, so the one that queued the first feedback applies the batch
+        rag = batch[0][0]
+        try:
+            output = f"Manifest change:\n{update_manifest_many(rag, [message for _, message in batch])}"
+        except Exception as e:
+            output = f"Error updating manifest: {e}"
+        
+        # The user is most likely at the prompt by now, so the output goes on its own lines
+        # and the prompt is repeated, unless the session is over
+        with output_lock:
+            prompt = QUESTION_PROMPT if session_running.is_set() else ""
+            sys.stdout.write(f"\n{output}\n{prompt}")
+            sys.stdout.flush()
+        for _ in batch:
+            feedback_queue.task_done()
+
+def handle_feedback(rag, message):
+    """Queue the feedback to update the manifest in the background, so that the next question is not held up"""
+    global feedback_queue
+    if feedback_queue is None:
+        feedback_queue = queue.Queue()
+        threading.Thread(target=apply_feedback, args=(feedback_queue,), daemon=True).start()
+    
+    feedback_queue.put((rag, message))
+
+def handle_other(rag, message):
+    """Answer messages that could not be classified as queries"""
+    print(MessageType.FEEDBACK)
+    print_answer(rag, message)
+
+# Handler of each message type, messages of any other type go to handle_other
+MESSAGE_HANDLERS = {
+    MessageType.QUERY: print_answer,
+    MessageType.FEEDBACK: handle_feedback,
+}
+
+@lru_cache(maxsize=1)
+def get_query_controller():
+    """Create the RAG system once per process, so that later sessions reuse its clients and caches"""
+    return QueryController(init_vector_db())
+
+def warmup(rag):
+    """Warm up the RAG system, leaving any failure to be reported by the first query"""
+    try:
+        rag.warmup()
+    except Exception:
+        pass
+
 def main():
     """Run user queries and process them using RAG"""
     
@@ -86,59 +185,57 @@ def main():
     
     # Initialize the RAG system
     print("\nInitializing RAG system...")
-    vector_db_provider = init_vector_db()
-    rag = QueryController(vector_db_provider)
+    rag = get_query_controller().with_category(selected_category)
+    # Connect to the services while the user is typing the first question
+    threading.Thread(target=warmup, args=(rag,), daemon=True).start()
     
     if selected_category:
         print(f"RAG system configured for category: {selected_category}")
-        # TODO: Configure RAG to focus on selected_category if your system supports it
-        # rag.set_category_filter(selected_category)
     else:
         print("RAG system configured for all categories")
 
     print("\nEnter your questions:")
     print("(Type 'change-category' to select a different category)")
     
+    session_running.set()
     while True:
-        message = input("\nYour question (or 'quit' to exit): ").strip()
+        message = input(QUESTION_PROMPT).strip()
+        command = message.lower()
         
-        if message.lower() in ['quit', 'exit', 'q']:
+        if command in EXIT_COMMANDS:
             break
         
-        if message.lower() == 'change-category':
+        if command == 'change-category':
             # Allow user to change category during the session
             new_category = select_category(categories)
             if new_category is False:
                 break
             selected_category = new_category
+            rag = rag.with_category(selected_category)
             if selected_category:
                 print(f"Switched to category: {selected_category}")
-                # TODO: Reconfigure RAG for new category
-                # rag.set_category_filter(selected_category)
             else:
                 print("Switched to all categories")
-                # TODO: Remove category filter
-                # rag.clear_category_filter()
             continue
         
         if message:
             try:
-                message_with_type = rag.feedback_or_query(message)
-                print(f"MESSAGE TYPE: {message_with_type['type']}")
+                message_type = rag.feedback_or_query(message)["type"]
+                # Shown right away, while the answer is being retrieved
+                with output_lock:
+                    sys.stdout.write(f"MESSAGE TYPE: {message_type}\n")
+                    sys.stdout.flush()
+                
+                handler = MESSAGE_HANDLERS.get(message_type, handle_other)
+                handler(rag, message)
                 
-                if message_with_type["type"] == MessageType.QUERY:
-                    answer = rag.query_with_rag(selected_category, message)
-                    print(f"Answer: {answer}")
-                elif message_with_type["type"] == MessageType.FEEDBACK:
-                    update_manifest(rag, message)
-                else:
-                    print(MessageType.FEEDBACK)
-                    answer = rag.query_with_rag(selected_category, message)
-                    print(f"Answer: {answer}")
-                    
             except Exception as e:
                 print(f"Error processing query: {e}")
     
+    # Let the feedback still being applied finish before exiting
+    session_running.clear()
+    if feedback_queue is not None:
+        feedback_queue.join()
     print("Goodbye!")
 
 if __name__ == "__main__":